@@ -5,7 +5,7 @@ not find api here.
 
 from .file_utils import get_resource_file_path, import_local_resources
 from .resource_processor import ResourceProcessor, DefaultResourceProcessor
-from ._utils import trim_before_target
+from ._utils import trim_before_target, pad_sentences, trimmed_length
 from .hooks import start_recorder, close_recorder
 
 __all__ = ['ResourceProcessor', 'DefaultResourceProcessor', 'get_resource_file_path', \
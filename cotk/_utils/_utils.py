@@ -1,6 +1,9 @@
 r"""
 ``cotk._utils`` is a function lib for internal use.
 """
+from itertools import chain
+
+import numpy as np
 
 def trim_before_target(lists, target):
 	'''Trim the list before the target. If there is no target,
@@ -16,3 +19,45 @@ def trim_before_target(lists, target):
 	except ValueError:
 		pass
 	return lists
+
+def pad_sentences(sentences, pad_id=0):
+	'''Pad sentences into a 2-d array. All the ids are written into the array
+	by one vectorized assignment, instead of a python loop over sentences.
+
+	Arguments:
+		sentences (list): a list of sentences, each of which is a list of int.
+		pad_id (int): the id used for padding. Default: ``0``.
+
+	Returns:
+		(tuple): containing:
+
+		* **padded** (:class:`numpy.ndarray`): A 2-d padded array.
+		  Size: ``[len(sentences), max(sent_length)]``
+		* **length** (:class:`numpy.ndarray`): A 1-d array, the length of each sentence.
+		  Size: ``[len(sentences)]``
+	'''
+	length = np.array([len(sent) for sent in sentences], dtype=int)
+	padded = np.full((len(sentences), max(length.tolist(), default=0)), pad_id, dtype=int)
+	padded[np.arange(padded.shape[1]) < length[:, None]] = \
+		np.fromiter(chain.from_iterable(sentences), dtype=int, count=np.sum(length))
+	return padded, length
+
+def trimmed_length(padded, eos_id, pad_id):
+	'''Compute the lengths of sentences after trimming, which is the vectorized version of
+	:meth:`cotk.dataloader.LanguageProcessingBase.trim` on a padded array. That is,
+	words from the first ``eos_id`` are abandoned, and then ``pad_id`` at the end are ignored.
+
+	Arguments:
+		padded (:class:`numpy.ndarray`): A padded array of int, whose last dimension is sentences.
+		eos_id (int): the id of end token.
+		pad_id (int): the id of padding token.
+
+	Returns:
+		(:class:`numpy.ndarray`): the lengths of trimmed sentences. Size: ``padded.shape[:-1]``
+	'''
+	if padded.shape[-1] == 0:
+		return np.zeros(padded.shape[:-1], dtype=int)
+	valid = (np.cumsum(padded == eos_id, axis=-1) == 0) & (padded != pad_id)
+	# the position after the last valid word
+	return np.where(np.any(valid, axis=-1), \
+		padded.shape[-1] - np.argmax(valid[..., ::-1], axis=-1), 0)
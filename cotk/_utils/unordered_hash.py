@@ -21,7 +21,7 @@ class UnorderedSha256:
 
 	def update_hash(self, hashvalue):
 		'''update digest by hash. type(hashvalue)=bytes'''
-		self.result += np.array(list(hashvalue), dtype=np.uint8)
+		self.result += np.frombuffer(hashvalue, dtype=np.uint8)
 
 	def digest(self):
 		'''return unordered hashvalue'''
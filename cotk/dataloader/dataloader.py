@@ -14,6 +14,21 @@ from .._utils import trim_before_target
 from .._utils.metaclass import DocStringInheritor, LoadClassInterface
 from .._utils.unordered_hash import UnorderedSha256
 
+def _tokenize_sentence(sentence, remains_capital, tokenizer):
+	r'''Convert sentence(str) to a list of tokens(str). It is a module-level function,
+	so that it can be sent to worker processes. See :meth:`LanguageProcessingBase.tokenize`.
+	'''
+	if remains_capital:
+		sentence = sentence.strip()
+	else:
+		sentence = sentence.lower().strip()
+	if tokenizer == 'nltk':
+		return WordPunctTokenizer().tokenize(sentence)
+	elif tokenizer == 'space':
+		return sentence.split()
+	else:
+		raise ValueError('tokenizer of dataloader should be either "nltk" or "space"')
+
 
 class DataField(LoadClassInterface, metaclass=DocStringInheritor):
 	"""A class that helps process a dataset. It knows the structure of a dataset. Thus, It can get sentences(or sessions,
@@ -514,16 +529,22 @@ class LanguageProcessingBase(Dataloader):
 		Returns:
 			list: a list of tokens(str)
 		'''
-		if remains_capital:
-			sentence = sentence.strip()
-		else:
-			sentence = sentence.lower().strip()
-		if tokenizer == 'nltk':
-			return WordPunctTokenizer().tokenize(sentence)
-		elif tokenizer == 'space':
-			return sentence.split()
-		else:
-			raise ValueError('tokenizer of dataloader should be either "nltk" or "space"')
+		return _tokenize_sentence(sentence, remains_capital, tokenizer)
+
+	def _convert_to_tokens(self, elements):
+		r'''Convert the raw elements of a dataset to tokens, invoked by :meth:`_general_load_data`.
+		Subclasses may override it to tokenize in parallel.
+
+		Arguments:
+			elements (iterator): the raw elements in the order of the file, as tuples of
+				``(data_key, field, element)``. They are read lazily from the file.
+
+		Returns:
+			iterator: tuples of ``(data_key, tokens)`` in the same order, where ``tokens``
+			is the element converted by ``field.convert_to_tokens``.
+		'''
+		for data_key, field, element in elements:
+			yield data_key, field.convert_to_tokens(element, self.tokenize)
 
 	def _general_load_data(self, file_path, data_fields, min_vocab_times, max_sent_length, max_turn_length,
 						   invalid_vocab_times):
@@ -575,6 +596,14 @@ class LanguageProcessingBase(Dataloader):
 			assert isinstance(fields, list) or isinstance(fields, tuple)
 			return [(data_key, DataField.get_field(field)) for data_key, field in fields]
 
+		def read_elements(f_file, fields):
+			while True:
+				try:
+					for data_key, field in fields:
+						yield data_key, field, field.get_next(f_file)
+				except StopIteration:
+					break
+
 		if isinstance(data_fields, dict):
 			no_field_keys = [key for key in self.key_name if key not in data_fields]
 			if no_field_keys:
@@ -600,17 +629,13 @@ class LanguageProcessingBase(Dataloader):
 		origin_data = {}
 		for key in self.key_name:
 			origin_data[key] = {data_key: [] for data_key, _ in data_fields[key]}
+			fields = dict(data_fields[key])
 			with open("%s/%s.txt" % (file_path, key), encoding='utf-8') as f_file:
-				while True:
-					try:
-						for data_key, field in data_fields[key]:
-							element = field.convert_to_tokens(field.get_next(f_file), self.tokenize)
-							for token in field.iter_tokens(element):
-								if token in special_tokens:
-									raise RuntimeError('The dataset contains special token "%s". This is not allowed.' % token)
-							origin_data[key][data_key].append(element)
-					except StopIteration:
-						break
+				for data_key, element in self._convert_to_tokens(read_elements(f_file, data_fields[key])):
+					for token in fields[data_key].iter_tokens(element):
+						if token in special_tokens:
+							raise RuntimeError('The dataset contains special token "%s". This is not allowed.' % token)
+					origin_data[key][data_key].append(element)
 
 		def chain_allvocab(dic, fields):
 			vocabs = []
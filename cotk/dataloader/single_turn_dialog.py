@@ -4,7 +4,8 @@ A module for single turn dialog.
 import os
 import time
 from collections import Counter
-from itertools import chain
+from itertools import chain, islice
+from functools import partial
 import multiprocessing
 from multiprocessing import Pool
 import tqdm
@@ -13,8 +14,8 @@ import numpy as np
 
 from nltk.tokenize import WordPunctTokenizer
 from .._utils.file_utils import get_resource_file_path
-from .._utils import hooks
-from .dataloader import LanguageProcessingBase
+from .._utils import hooks, pad_sentences
+from .dataloader import LanguageProcessingBase, _tokenize_sentence
 from .bert_dataloader import BERTLanguageProcessingBase
 from ..metric import MetricChain, PerplexityMetric, BleuCorpusMetric, SingleTurnDialogRecorder
 
@@ -82,6 +83,38 @@ class SingleTurnDialog(LanguageProcessingBase):
 		return super().tokenize(sentence, remains_capital or self._remains_capital, \
 			tokenizer or self._tokenizer)
 
+	@staticmethod
+	def _run_convert_to_tokens(data_element, remains_capital, tokenizer):
+		data_key, field, element = data_element
+		return data_key, field.convert_to_tokens(element, \
+			partial(_tokenize_sentence, remains_capital=remains_capital, tokenizer=tokenizer))
+
+	MP_SMALL_SIZE = 10000
+	def _convert_to_tokens(self, elements):
+		r'''Tokenize the elements by multiple processes if there are at least
+		``MP_SMALL_SIZE`` elements. Only the first ``MP_SMALL_SIZE`` elements are
+		buffered to decide it, the others are streamed to the workers.
+		The number of processes is read from the ``CPU_COUNT`` environment variable,
+		or defaults to the number of cpus. Subclasses overriding :meth:`tokenize`
+		always tokenize in this process, since the workers only run the default tokenizers.
+		'''
+		if "CPU_COUNT" in os.environ:
+			cpu_count = int(os.environ["CPU_COUNT"])
+		else:
+			cpu_count = multiprocessing.cpu_count()
+		if cpu_count <= 1 or type(self).tokenize is not __class__.tokenize:
+			yield from super()._convert_to_tokens(elements)
+			return
+
+		head = list(islice(elements, __class__.MP_SMALL_SIZE))
+		if len(head) < __class__.MP_SMALL_SIZE:
+			yield from super()._convert_to_tokens(iter(head))
+			return
+		with Pool(cpu_count) as pool:
+			yield from pool.imap(partial(self._run_convert_to_tokens, \
+				remains_capital=self._remains_capital, tokenizer=self._tokenizer), \
+				chain(head, elements), chunksize=1024)
+
 	def _load_data(self):
 		r'''Loading dataset, invoked during the initialization of :class:`LanguageProcessingBase`.
 		'''
@@ -142,16 +175,11 @@ class SingleTurnDialog(LanguageProcessingBase):
 		if key not in self.key_name:
 			raise ValueError("No set named %s." % key)
 		res = {}
-		batch_size = len(indexes)
-		res["post_length"] = np.array(list(map(lambda i: len(self.data[key]['post'][i]), indexes)), dtype=int)
-		res["resp_length"] = np.array(list(map(lambda i: len(self.data[key]['resp'][i]), indexes)), dtype=int)
-		res_post = res["post"] = np.zeros((batch_size, np.max(res["post_length"])), dtype=int)
-		res_resp = res["resp"] = np.zeros((batch_size, np.max(res["resp_length"])), dtype=int)
-		for i, j in enumerate(indexes):
-			post = self.data[key]['post'][j]
-			resp = self.data[key]['resp'][j]
-			res_post[i, :len(post)] = post
-			res_resp[i, :len(resp)] = resp
+		res_post, res["post_length"] = pad_sentences( \
+			[self.data[key]['post'][i] for i in indexes], self.pad_id)
+		res_resp, res["resp_length"] = pad_sentences( \
+			[self.data[key]['resp'][i] for i in indexes], self.pad_id)
+		res["post"], res["resp"] = res_post, res_resp
 
 		res["post_allvocabs"] = res_post.copy()
 		res["resp_allvocabs"] = res_resp.copy()
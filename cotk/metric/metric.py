@@ -127,7 +127,8 @@ class MetricBase(LoadClassInterface, metaclass=DocStringInheritor):
 		'''Invoked by :meth:`.forward` or :meth:`.close` to hash relevant data when computing a metric.
 
 		Arguments:
-			data_list (list): relevant data organized as list.
+			data_list (list): relevant data organized as list. Any iterable is accepted,
+				as the items are consumed one by one.
 		'''
 		for item in data_list:
 			self.unordered_hash.update_data(repr(item).encode())
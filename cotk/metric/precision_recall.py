@@ -1,11 +1,64 @@
 r"""
 Containing some classes and functions about precision and recall evaluating results of models.
 """
+import os
+import math
+from collections import Counter
 from itertools import chain
+from functools import lru_cache
+import multiprocessing
+from multiprocessing import Pool
 import numpy as np
-from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
+from nltk.translate.bleu_score import SmoothingFunction
 from .metric import MetricBase
-from .._utils import hooks
+from .._utils import hooks, pad_sentences, trimmed_length
+
+@lru_cache(maxsize=8192)
+def _ngram_counter(tokens, n):
+	'''Auxiliary function for counting n-grams of a sentence. The results are cached,
+	because a sentence is usually compared with many other sentences.
+
+	Arguments:
+		tokens (tuple): a sentence.
+		n (int): the order of n-grams.
+
+	Returns:
+
+		* :class:`collections.Counter`: counts of n-grams. It is shared by all callers
+		  and must not be modified.
+	'''
+	return Counter(zip(*[tokens[i:] for i in range(n)]))
+
+def _sentence_bleu(ele):
+	'''Auxiliary function for computing sentence bleu with a single reference.
+	It gives the same result as :func:`nltk.translate.bleu_score.sentence_bleu` with
+	``SmoothingFunction().method1``, but reuses n-gram counts from :func:`_ngram_counter`.
+
+	Arguments:
+		ele (tuple): A tuple (`a reference sentence`, `a hypothesis sentence`, `weights`),
+			where the sentences are tuples.
+
+	Returns:
+
+		* int: **sentence-bleu** value.
+	'''
+	reference, hypothesis, weights = ele
+	log_precisions = []
+	for n, weight in enumerate(weights, 1):
+		hyp_counts = _ngram_counter(hypothesis, n)
+		numerator = sum((hyp_counts & _ngram_counter(reference, n)).values())
+		denominator = max(1, sum(hyp_counts.values()))
+		if numerator == 0:
+			if n == 1:
+				return 0
+			numerator = SmoothingFunction().epsilon
+		log_precisions.append(weight * math.log(numerator / denominator))
+
+	if len(hypothesis) > len(reference):
+		brevity_penalty = 1
+	else:
+		brevity_penalty = math.exp(1 - len(reference) / len(hypothesis))
+	return brevity_penalty * math.exp(math.fsum(log_precisions))
 
 class _PrecisionRecallMetric(MetricBase):
 	r"""Base class for precision recall metrics. This is an abstract class.
@@ -38,6 +91,14 @@ class _PrecisionRecallMetric(MetricBase):
 		self.prec_list = []
 		self.rec_list = []
 		self.res_prefix = ""
+		self._unk_id = dataloader.unk_id
+		self._eos_id = dataloader.eos_id
+		self._pad_id = dataloader.pad_id
+		# score matrices are views of this buffer, which is reused across batches
+		self._matrix_buffer = np.empty(0, dtype=np.float32)
+		# buffers for the maximum of each column (generated sentence) and row (reference)
+		self._col_max = np.empty(0, dtype=np.float32)
+		self._row_max = np.empty(0, dtype=np.float32)
 
 	def _score(self, gen, reference):
 		r'''This function is called by :func:`forward`.
@@ -52,6 +113,109 @@ class _PrecisionRecallMetric(MetricBase):
 		raise NotImplementedError( \
 			"This function should be implemented by subclasses.")
 
+	def _score_matrix(self, reference, gen):
+		r'''Compute the scores between all pairs of references and generated sentences
+		of a context. See :func:`_score_matrices`.
+
+		Arguments:
+			reference (list): list of references, each of which is a list of word ids.
+			gen (list): list of generated sentences, each of which is a list of word ids.
+
+		Returns:
+			:class:`numpy.ndarray`: A 2-d float32 array, whose size is
+			``[len(reference), len(gen)]`` and ``matrix[i][j]`` is the score of
+			``gen[j]`` against ``reference[i]``.
+		'''
+		# copied, since the result of :func:`_score_matrices` is overwritten by the next call
+		return self._score_matrices([reference], [gen])[0].copy()
+
+	def _get_matrix_buffer(self, size):
+		r'''Get the first ``size`` elements of the score matrix buffer. The buffer is
+		only reallocated when it is too small, so the contents are valid until the next call.
+
+		Arguments:
+			size (int): the number of elements.
+
+		Returns:
+			:class:`numpy.ndarray`: An uninitialized 1-d float32 array.
+		'''
+		if self._matrix_buffer.size < size:
+			self._matrix_buffer = np.empty(size, dtype=np.float32)
+		return self._matrix_buffer[:size]
+
+	def _matrix_views(self, references, gens):
+		r'''Get uninitialized score matrices for a batch. They are views of the buffer
+		returned by :func:`_get_matrix_buffer`.
+
+		Arguments:
+			references (list): list of references of each context.
+			gens (list): list of generated sentences of each context.
+
+		Returns:
+			list: list of 2-d float32 arrays, whose sizes are ``[len(reference), len(gen)]``.
+			Their elements are contiguous in the buffer and in the same order.
+		'''
+		shapes = [(len(reference), len(gen)) for reference, gen in zip(references, gens)]
+		buffer = self._get_matrix_buffer(sum(ref_num * gen_num for ref_num, gen_num in shapes))
+
+		matrices = []
+		offset = 0
+		for ref_num, gen_num in shapes:
+			matrices.append(buffer[offset:offset + ref_num * gen_num] \
+							.reshape(ref_num, gen_num))
+			offset += ref_num * gen_num
+		return matrices
+
+	def _score_matrices(self, references, gens):
+		r'''This function is called by :func:`forward` to compute the score matrices
+		of a batch. By default, it calls :func:`_score` for each pair of sentences.
+		Subclasses may override it with a vectorized implementation.
+
+		Arguments:
+			references (list): list of references of each context.
+			gens (list): list of generated sentences of each context.
+
+		Returns:
+			list: list of score matrices, one for each context. See :func:`_score_matrix`.
+		'''
+		matrices = self._matrix_views(references, gens)
+		for matrix, reference, gen in zip(matrices, references, gens):
+			for i, single_ref in enumerate(reference):
+				for j, single_gen in enumerate(gen):
+					matrix[i][j] = self._score(single_gen, single_ref)
+		return matrices
+
+	def _trim_batch(self, batch, start=0):
+		r'''Trim every sentence of a batch as :meth:`.dataloader.LanguageProcessingBase.trim`
+		does. All the sentences are padded into one 2-d array first, so that the
+		lengths are computed by vectorized operations.
+
+		Arguments:
+			batch (list or :class:`numpy.ndarray`): A 3-d jagged or padded array.
+				Size: ``[batch_size, ~sentence_num, ~word_num]``.
+			start (int): Words before ``start`` are dropped before trimming. Default: ``0``.
+
+		Returns:
+			list: A 3-d jagged list of trimmed sentences.
+		'''
+		if isinstance(batch, np.ndarray) and batch.ndim == 3:
+			padded = batch[:, :, start:]
+			padded = padded.reshape(padded.shape[0] * padded.shape[1], padded.shape[2])
+			sentence_num = [batch.shape[1]] * batch.shape[0]
+		else:
+			padded, _ = pad_sentences([sent[start:] for inst in batch for sent in inst], \
+				self._pad_id)
+			sentence_num = [len(inst) for inst in batch]
+		length = trimmed_length(padded, self._eos_id, self._pad_id)
+		sentences = [sent[:sent_len] for sent, sent_len in zip(padded.tolist(), length.tolist())]
+
+		res = []
+		offset = 0
+		for num in sentence_num:
+			res.append(sentences[offset:offset + num])
+			offset += num
+		return res
+
 	def forward(self, data):
 		'''Processing a batch of data.
 
@@ -89,10 +253,8 @@ class _PrecisionRecallMetric(MetricBase):
 		if not isinstance(multiple_gen, (np.ndarray, list)):
 			raise TypeError("Unknown type for multiple_gen")
 
-		references = [[self.dataloader.trim(cand[1:]) for cand in inst] \
-					  for inst in candidate_allvocabs]
-		gens = [[self.dataloader.trim(cand) for cand in inst] \
-					  for inst in multiple_gen]
+		references = self._trim_batch(candidate_allvocabs, start=1)
+		gens = self._trim_batch(multiple_gen)
 
 		if len(references) != len(gens):
 			raise ValueError("Batch num is not matched.")
@@ -103,15 +265,19 @@ class _PrecisionRecallMetric(MetricBase):
 					"Number of geneated sentences per context does not equal to\
 					the specified `generated_num_per_context`")
 
-		self._hash_relevant_data(list(chain(*references)))
-		for reference, gen in zip(references, gens):
+		self._hash_relevant_data(chain.from_iterable(references))
+		matrices = self._score_matrices(references, gens)
+		if self._col_max.size < self.generated_num_per_context:
+			self._col_max = np.empty(self.generated_num_per_context, dtype=np.float32)
+		max_ref_num = max(map(len, references), default=0)
+		if self._row_max.size < max_ref_num:
+			self._row_max = np.empty(max_ref_num, dtype=np.float32)
+		for reference, gen, matrix in zip(references, gens, matrices):
 			# pylint: disable=no-member
-			matrix = np.zeros((len(reference), len(gen)), dtype=np.float32)
-			for i, single_ref in enumerate(reference):
-				for j, single_gen in enumerate(gen):
-					matrix[i][j] = self._score(single_gen, single_ref)
-			self.prec_list.append(float(np.sum(np.max(matrix, 0))) / len(gen))
-			self.rec_list.append(float(np.sum(np.max(matrix, 1))) / len(reference))
+			col_max = np.max(matrix, 0, out=self._col_max[:len(gen)])
+			row_max = np.max(matrix, 1, out=self._row_max[:len(reference)])
+			self.prec_list.append(float(np.sum(col_max)) / len(gen))
+			self.rec_list.append(float(np.sum(row_max)) / len(reference))
 
 	@hooks.hook_metric_close
 	def close(self):
@@ -144,6 +310,7 @@ class BleuPrecisionRecallMetric(_PrecisionRecallMetric):
 	Arguments:
 		{_PrecisionRecallMetric.ARGUMENTS}
 		ngram (int): Specifies using BLEU-ngram.
+		{MetricBase.CPU_COUNT_ARGUMENTS}
 
 	Here is an exmaple:
 
@@ -172,10 +339,17 @@ class BleuPrecisionRecallMetric(_PrecisionRecallMetric):
 				 ngram, \
 				 generated_num_per_context, \
 				 candidates_allvocabs_key='candidate_allvocabs', \
-				 multiple_gen_key='multiple_gen'):
+				 multiple_gen_key='multiple_gen', \
+				 cpu_count=None):
 		super().__init__(self._name, self._version, \
 				dataloader, generated_num_per_context, candidates_allvocabs_key, \
 				multiple_gen_key)
+		if cpu_count is not None:
+			self.cpu_count = cpu_count
+		elif "CPU_COUNT" in os.environ and os.environ["CPU_COUNT"] is not None:
+			self.cpu_count = int(os.environ["CPU_COUNT"])
+		else:
+			self.cpu_count = multiprocessing.cpu_count()
 		if ngram not in range(1, 5):
 			raise ValueError("ngram should belong to [1, 4]")
 		self.ngram = ngram
@@ -194,16 +368,37 @@ class BleuPrecisionRecallMetric(_PrecisionRecallMetric):
 
 			* list: processed result.
 		'''
-		output = []
-		for ele in _input:
-			output.append(_target if ele == self.dataloader.unk_id else ele)
-		return output
+		_input = np.asarray(_input)
+		return np.where(_input == self._unk_id, _target, _input).tolist()
+
+	# starting a pool costs about as much as scoring 1000 pairs serially
+	MP_SMALL_SIZE = 10000
+	def _score_matrices(self, references, gens):
+		# unknown words are replaced once for each generated sentence,
+		# rather than once for each pair of sentences
+		gens = [[tuple(self._replace_unk(single_gen)) for single_gen in gen] for gen in gens]
+		references = [[tuple(single_ref) for single_ref in reference] for reference in references]
+		tasks = [(single_ref, single_gen, self.weights) \
+				 for reference, gen in zip(references, gens) \
+				 for single_ref in reference for single_gen in gen]
+		if len(tasks) >= __class__.MP_SMALL_SIZE and self.cpu_count > 1:
+			# use multiprocessing, the workers are terminated even if scoring raises
+			with Pool(self.cpu_count) as pool:
+				values = list(pool.imap(_sentence_bleu, tasks, chunksize=64))
+		else:
+			values = list(map(_sentence_bleu, tasks))
+
+		# tasks are in the same order as the elements of matrices
+		matrices = self._matrix_views(references, gens)
+		self._get_matrix_buffer(len(values))[:] = values
+		return matrices
 
 	def _score(self, gen, reference):
 		r'''Score function of BLEU-ngram precision and recall.
 
 		Arguments:
-			gen (list): list of generated word ids.
+			gen (list): list of generated word ids, where unknown words
+				have been replaced by :func:`_replace_unk`.
 			reference (list): list of word ids of a reference.
 
 		Returns:
@@ -216,8 +411,7 @@ class BleuPrecisionRecallMetric(_PrecisionRecallMetric):
 			>>> self._score(gen, reference)
 			0.150 # assume self.weights = [0.25,0.25,0.25,0.25]
 		'''
-		gen = self._replace_unk(gen)
-		return sentence_bleu([reference], gen, self.weights, SmoothingFunction().method1)
+		return _sentence_bleu((tuple(reference), tuple(gen), self.weights))
 
 class EmbSimilarityPrecisionRecallMetric(_PrecisionRecallMetric):
 	r'''Metric for calculating cosine similarity precision and recall.
@@ -271,18 +465,92 @@ class EmbSimilarityPrecisionRecallMetric(_PrecisionRecallMetric):
 			candidates_allvocabs_key, multiple_gen_key)
 		if not isinstance(word2vec, dict):
 			raise ValueError("word2vec has invalid type")
+		self._dim = 0
 		if word2vec:
-			embed_shape = np.array(list(word2vec.values())).shape
-			if len(embed_shape) != 2 or embed_shape[1] == 0:
+			# check the shapes one by one instead of stacking all the embeddings
+			embed_shape = np.shape(next(iter(word2vec.values())))
+			if len(embed_shape) != 1 or embed_shape[0] == 0 or \
+					not all(np.shape(emb) == embed_shape for emb in word2vec.values()):
 				raise ValueError("word embeddings have inconsistent embedding size or are empty")
+			self._dim = embed_shape[0]
 		if mode not in ['avg', 'extrema']:
 			raise ValueError("mode should be 'avg' or 'extrema'.")
 		self.word2vec = word2vec
+		# Embeddings are gathered by word ids through ``_emb_row``, which is -1 for words
+		# without embedding, so that only those with embedding take a row of ``_emb``.
+		# They are kept in float32, since float16 would change the values of the metric.
+		all_vocab_list = self.dataloader.all_vocab_list
+		emb_ids = [i for i, word in enumerate(all_vocab_list) if word in word2vec]
+		self._emb_row = np.full(len(all_vocab_list), -1, dtype=int)
+		self._emb_row[emb_ids] = np.arange(len(emb_ids))
+		self._emb = np.array([word2vec[all_vocab_list[i]] for i in emb_ids], \
+							 dtype=np.float32).reshape(len(emb_ids), self._dim)
 		self.mode = mode
 		self.res_prefix = '{}-bow'.format(mode)
 		self._hash_relevant_data([mode, generated_num_per_context] + \
 				[(word, list(emb)) for word, emb in self.word2vec.items()])
 
+	def _normalized_embeds(self, sentences):
+		r'''Compute the L2-normalized bag-of-word representations of sentences.
+		Sentences without embedding are filled with zeros and marked in the mask.
+
+		Arguments:
+			sentences (list): list of sentences, each of which is a list of word ids.
+
+		Returns:
+			(tuple): containing:
+
+			* :class:`numpy.ndarray`: embeddings of size ``[len(sentences), embedding_size]``.
+			* :class:`numpy.ndarray`: a boolean mask, ``True`` if the sentence has an embedding.
+		'''
+		length = np.array([len(sent) for sent in sentences], dtype=int)
+		ids = np.fromiter(chain.from_iterable(sentences), dtype=int, count=np.sum(length))
+		rows = self._emb_row[ids]
+		has_emb = rows >= 0
+		# words with embedding are gathered once for all sentences, then
+		# reduced by segments instead of one temporary array per sentence
+		vec = self._emb[rows[has_emb]]
+		count = np.bincount(np.repeat(np.arange(len(sentences)), length)[has_emb], \
+							minlength=len(sentences))
+		valid = count > 0
+
+		embeds = np.zeros((len(sentences), self._dim), dtype=np.float32)
+		if np.any(valid):
+			start = (np.cumsum(count) - count)[valid]
+			if self.mode == 'avg':
+				# the mean is not divided by the count, which is cancelled by the normalization
+				valid_embeds = np.add.reduceat(vec, start, axis=0)
+			else:
+				valid_embeds = np.maximum.reduceat(vec, start, axis=0)
+			# kept in float32, so the similarities are computed by BLAS sgemm
+			valid_embeds /= np.linalg.norm(valid_embeds, axis=1, keepdims=True).clip(1e-12)
+			embeds[valid] = valid_embeds
+		return embeds, valid
+
+	def _score_matrices(self, references, gens):
+		# every distinct sentence of the batch is embedded only once
+		sentence_index = {}
+		for sent in chain(chain.from_iterable(references), chain.from_iterable(gens)):
+			sentence_index.setdefault(tuple(sent), len(sentence_index))
+		# the last one is an empty sentence, which pads the contexts with fewer sentences
+		embeds, valid = self._normalized_embeds(list(sentence_index) + [()])
+		ref_index, _ = pad_sentences([[sentence_index[tuple(sent)] for sent in reference] \
+									  for reference in references], -1)
+		gen_index, _ = pad_sentences([[sentence_index[tuple(sent)] for sent in gen] \
+									  for gen in gens], -1)
+
+		# All the contexts are computed by one batched matrix multiplication, instead of
+		# a python loop over contexts. It runs without the GIL and BLAS may use multiple threads.
+		matrices = self._get_matrix_buffer(ref_index.size * gen_index.shape[1]) \
+			.reshape(ref_index.shape + gen_index.shape[1:])
+		np.matmul(embeds[ref_index], embeds[gen_index].transpose(0, 2, 1), out=matrices)
+		matrices += 1
+		matrices /= 2
+		# a pair is scored 0 if any of the sentences has no embedding
+		matrices *= valid[ref_index][:, :, None] & valid[gen_index][:, None, :]
+		return [matrix[:len(reference), :len(gen)] \
+				for matrix, reference, gen in zip(matrices, references, gens)]
+
 	def _score(self, gen, reference):
 		r'''Score function of cosine similarity precision and recall.
 
@@ -300,23 +568,8 @@ class EmbSimilarityPrecisionRecallMetric(_PrecisionRecallMetric):
 			>>> self._score(gen, reference)
 			0.135 # assume self.mode = 'avg'
 		'''
-		gen_vec = []
-		ref_vec = []
-		for word in self.dataloader.convert_ids_to_tokens(gen):
-			if word in self.word2vec:
-				gen_vec.append(self.word2vec[word])
-		for word in self.dataloader.convert_ids_to_tokens(reference):
-			if word in self.word2vec:
-				ref_vec.append(self.word2vec[word])
-		if not gen_vec or not ref_vec:
-			return 0
-		if self.mode == 'avg':
-			gen_embed = np.average(gen_vec, 0)
-			ref_embed = np.average(ref_vec, 0)
-		else:
-			gen_embed = np.max(gen_vec, 0)
-			ref_embed = np.max(ref_vec, 0)
-		cos = np.sum(gen_embed * ref_embed) / \
-			  np.sqrt(np.sum(gen_embed * gen_embed) * np.sum(ref_embed * ref_embed))
-		norm = (cos + 1) / 2
-		return norm
+		# the two sentences are looked up by word ids directly, without the batch machinery
+		embeds, valid = self._normalized_embeds([reference, gen])
+		if not np.all(valid):
+			return 0.
+		return float((np.dot(embeds[0], embeds[1]) + 1) / 2)
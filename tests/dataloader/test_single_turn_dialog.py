@@ -226,5 +226,22 @@ class TestOpenSubtitles(TestSingleTurnDialog):
 	def test_init_multi_runs(self, load_opensubtitles):
 		super().base_test_multi_runs([load_opensubtitles() for i in range(3)])
 
+	def test_multiprocessing_tokenize(self, load_opensubtitles, monkeypatch):
+		dl = load_opensubtitles()
+		monkeypatch.setattr(SingleTurnDialog, "MP_SMALL_SIZE", 1)
+		monkeypatch.setenv("CPU_COUNT", "2")
+		mp_dl = load_opensubtitles()
+		assert mp_dl.all_vocab_list == dl.all_vocab_list
+		assert mp_dl.data == dl.data
+
+		# an overridden tokenize is not bypassed by the workers
+		class SpaceOpenSubtitles(OpenSubtitles):
+			def tokenize(self, sentence, remains_capital=None, tokenizer=None):
+				return super().tokenize(sentence, remains_capital, 'space')
+		space_dl = SpaceOpenSubtitles("./tests/dataloader/dummy_opensubtitles#OpenSubtitles")
+		assert space_dl.all_vocab_list != dl.all_vocab_list
+		monkeypatch.setattr(SingleTurnDialog, "MP_SMALL_SIZE", 10000)
+		assert SpaceOpenSubtitles("./tests/dataloader/dummy_opensubtitles#OpenSubtitles").data == space_dl.data
+
 
 base_test_version(OpenSubtitles)
@@ -3,7 +3,10 @@ import random
 import numpy as np
 import pytest
 
+from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
+
 from cotk.metric import BleuPrecisionRecallMetric, EmbSimilarityPrecisionRecallMetric
+from cotk.metric.precision_recall import _sentence_bleu
 
 from metric_base import *
 
@@ -104,6 +107,62 @@ class TestBleuPrecisionRecallMetric():
 
 		assert same_dict(data, _data)
 
+	@pytest.mark.parametrize('pad', [True, False])
+	def test_trim_batch(self, pad):
+		dataloader = FakeMultiDataloader()
+		bprm = BleuPrecisionRecallMetric(dataloader, 4, 3)
+		batch = [[[random.choice([0, 3, 4, 5, 6]) for _ in range(random.randint(0, 8))] \
+				  for _ in range(random.randint(1, 4))] for _ in range(20)]
+		if pad:
+			batch = np.array([[sent + [0] * (8 - len(sent)) for sent in inst + [[]] * (4 - len(inst))] \
+							  for inst in batch])
+		# sentences are all empty after trimming, so the padded batch has no columns
+		empty_batch = [[[], []], [[], []]]
+		go_batch = [[[2], [2]], [[2], [2]]]
+		if pad:
+			empty_batch = np.zeros((2, 2, 0), dtype=int)
+			go_batch = np.full((2, 2, 1), 2)
+		for start in [0, 1]:
+			for _batch in [batch, empty_batch, go_batch]:
+				trimmed = bprm._trim_batch(_batch, start)
+				assert len(trimmed) == len(_batch)
+				for trimmed_inst, inst in zip(trimmed, _batch):
+					assert trimmed_inst == [dataloader.trim(list(sent[start:])) for sent in inst]
+
+	def test_forward_empty(self):
+		dataloader = FakeMultiDataloader()
+		for data in [{'candidate_allvocabs': [[[2, 4, 5, 3], [2, 6]]], 'multiple_gen': [[[], []]]}, \
+					 {'candidate_allvocabs': [[[2], [2]]], 'multiple_gen': [[[4, 5], [6]]]}]:
+			bprm = BleuPrecisionRecallMetric(dataloader, 2, 2)
+			bprm.forward(data)
+			ans = bprm.close()
+			assert ans['BLEU-2 precision'] == 0
+			assert ans['BLEU-2 recall'] == 0
+
+	@pytest.mark.parametrize('ngram', [1, 2, 3, 4])
+	def test_sentence_bleu(self, ngram):
+		weights = [1 / ngram] * ngram
+		for _ in range(200):
+			reference = [random.randint(-1, 6) for _ in range(random.randint(0, 8))]
+			gen = [random.randint(-1, 6) for _ in range(random.randint(0, 8))]
+			assert _sentence_bleu((tuple(reference), tuple(gen), weights)) == \
+				sentence_bleu([reference], gen, weights, SmoothingFunction().method1)
+
+	def test_multiprocessing(self, monkeypatch):
+		dataloader = FakeMultiDataloader()
+		reference_key, gen_key = self.default_keywords
+		monkeypatch.setattr(BleuPrecisionRecallMetric, "MP_SMALL_SIZE", 1000)
+		# 3 references * 3 generated sentences * 120 contexts >= 1000 pairs
+		data = dataloader.get_data(reference_key=reference_key, gen_key=gen_key, \
+								   to_list=True, pad=False, \
+								   ref_len='non-empty', gen_len='non-empty', \
+								   batch=120, test_prec_rec=True)
+		bprm = BleuPrecisionRecallMetric(dataloader, 4, 3, cpu_count=1)
+		bprm_mp = BleuPrecisionRecallMetric(dataloader, 4, 3, cpu_count=2)
+		bprm.forward(data)
+		bprm_mp.forward(data)
+		assert same_dict(bprm.close(), bprm_mp.close(), False)
+
 	def test_version(self):
 		version_test(BleuPrecisionRecallMetric, dataloader=FakeMultiDataloader())
 
@@ -246,5 +305,46 @@ class TestEmbSimilarityPrecisionRecallMetric():
 
 		assert same_dict(data, _data)
 
+	@pytest.mark.parametrize('emb_mode', ['avg', 'extrema'])
+	def test_score_matrix(self, emb_mode):
+		dataloader = FakeMultiDataloader()
+		emb = {}
+		for word in dataloader.all_vocab_list[4:dataloader.valid_vocab_len]:
+			emb[word] = np.random.rand(5) - 0.5
+		espr = EmbSimilarityPrecisionRecallMetric(dataloader, emb, emb_mode, 3)
+		reference = [[4, 5, 6], [7, 9], [1, 9]]
+		gen = [[5, 7], [6], [10]]
+
+		def naive_score(gen, reference):
+			gen_vec = [emb[w] for w in dataloader.convert_ids_to_tokens(gen) if w in emb]
+			ref_vec = [emb[w] for w in dataloader.convert_ids_to_tokens(reference) if w in emb]
+			if not gen_vec or not ref_vec:
+				return 0
+			reduce = np.average if emb_mode == 'avg' else np.max
+			gen_embed, ref_embed = reduce(gen_vec, 0), reduce(ref_vec, 0)
+			cos = np.dot(gen_embed, ref_embed) / np.linalg.norm(gen_embed) / np.linalg.norm(ref_embed)
+			return (cos + 1) / 2
+
+		matrix = espr._score_matrix(reference, gen)
+		assert matrix.shape == (3, 3)
+		for i, single_ref in enumerate(reference):
+			for j, single_gen in enumerate(gen):
+				assert np.isclose(matrix[i][j], naive_score(single_gen, single_ref), atol=1e-6)
+				assert np.isclose(espr._score(single_gen, single_ref), matrix[i][j])
+
+	@pytest.mark.parametrize('emb_mode', ['avg', 'extrema'])
+	def test_forward_empty(self, emb_mode):
+		dataloader = FakeMultiDataloader()
+		emb = {}
+		for word in dataloader.all_vocab_list[4:dataloader.valid_vocab_len]:
+			emb[word] = np.random.rand(5) - 0.5
+		for data in [{'candidate_allvocabs': [[[2, 4, 5, 3], [2, 6]]], 'multiple_gen': [[[], []]]}, \
+					 {'candidate_allvocabs': [[[2], [2]]], 'multiple_gen': [[[4, 5], [6]]]}]:
+			espr = EmbSimilarityPrecisionRecallMetric(dataloader, emb, emb_mode, 2)
+			espr.forward(data)
+			ans = espr.close()
+			assert ans['%s-bow precision' % emb_mode] == 0
+			assert ans['%s-bow recall' % emb_mode] == 0
+
 	def test_version(self):
 		version_test(EmbSimilarityPrecisionRecallMetric, dataloader=FakeMultiDataloader())